@@ -1,17 +1,37 @@
+# Patch the standard library before anything else imports it, so that blocking file
+# and socket I/O in request and chat handlers yields to other greenlets instead of
+# stalling every connection on the server.
+from gevent import monkey
+monkey.patch_all()
+
 import argparse
-import calendar
 import datetime
 import emoji
+import functools
+import orjson
 import os
 import random
+import re
+import socket
+import time
 import webcolors  # type: ignore
 import yaml
-from flask import Flask, Request, Response, abort, jsonify, render_template, request as base_request, redirect, make_response, url_for
+from collections import defaultdict
+from flask import Flask, Request, Response, abort, g, jsonify, render_template, request as base_request, redirect, make_response, send_from_directory, url_for
 from flask_socketio import SocketIO, join_room  # type: ignore
 from flask_cors import CORS  # type: ignore
-from typing import Any, Dict, List, Optional, cast
+from sqlalchemy.sql import text
+from gevent.lock import Semaphore
+from gevent.pywsgi import WSGIServer
+from geventwebsocket.handler import WebSocketHandler  # type: ignore
+from typing import Any, Callable, DefaultDict, Dict, List, Match, Optional, Set, Tuple, cast
 from werkzeug.middleware.proxy_fix import ProxyFix
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore
+
 from data import Data
 
 
@@ -19,11 +39,64 @@ from data import Data
 FRONTEND_CACHE_BUST: str = "site.1.0.0"
 
 
+# Emoji names available for autocomplete on the stream page. These never change,
+# so build them once instead of on every page load.
+_EMOJIS: Dict[str, str] = {
+    key: value
+    for key, value in {
+        **emoji.get_emoji_unicode_dict('en'),  # type: ignore
+        **emoji.get_aliases_unicode_dict(),  # type: ignore
+    }.items()
+    if "__" not in key
+}
+
+
+# Emoji names substituted into chat messages and descriptions, with aliases taking
+# precedence over plain English names. Names are found with the same pattern the
+# emoji library uses for ":name:" tokens so that only one pass over the message
+# is needed instead of one emojize pass per language.
+_EMOJI_MAP: Dict[str, str] = {
+    **emoji.get_emoji_unicode_dict('en'),  # type: ignore
+    **emoji.get_aliases_unicode_dict(),  # type: ignore
+}
+_EMOJI_RE = re.compile(r":[\w\-&.’”“()!#*+?,/]+:")
+
+
+# Color names that "/color random" picks from.
+_CSS3_NAMES = tuple(webcolors.CSS3_NAMES_TO_HEX)
+
+
+# Fixed statements for the admin chat commands, built once instead of on every command.
+_UPDATE_DESCRIPTION = text("UPDATE streamersettings SET `description` = :description WHERE `username` = :streamer")
+_UPDATE_STREAMPASS = text("UPDATE streamersettings SET `streampass` = :password WHERE `username` = :streamer")
+
+
+class OrjsonCodec:
+    """
+    Lets python-socketio encode and decode packets with orjson. orjson always writes
+    compact output and returns bytes, so the stdlib's formatting arguments are ignored
+    and the result is decoded back to the str that the packet encoder expects.
+    """
+
+    @staticmethod
+    def dumps(obj: Any, *args: Any, **kwargs: Any) -> str:
+        return orjson.dumps(obj).decode('utf-8')
+
+    @staticmethod
+    def loads(data: Any, *args: Any, **kwargs: Any) -> Any:
+        return orjson.loads(data)
+
+
 app = Flask(__name__)
 CORS(app)
-socketio = SocketIO(app, cors_allowed_origins='*')
+# Bound to the app in load_config, once we know whether a message queue is configured.
+socketio = SocketIO(cors_allowed_origins='*', async_mode='gevent', async_handlers=True, json=OrjsonCodec)
 config: Dict[str, Any] = {}
 
+# Frequently used config values, filled in by load_config().
+HLS_DIR: str = ""
+HLS_TTL: int = 0
+
 
 # A quick hack to teach mypy about the valid SID parameter.
 class StreamingRequest(Request):
@@ -35,21 +108,28 @@ request: StreamingRequest = cast(StreamingRequest, base_request)
 
 def mysql() -> Data:
     global config
-    return Data(config)
 
+    # One Data for the whole process, built in load_config. Flask-SocketIO runs event
+    # handlers inside an app context as well, so marking it here lets the teardown
+    # below hand the session's connection back to the pool for both HTTP requests
+    # and chat events.
+    g._db = True
+    return cast(Data, config['database']['data'])
 
-def now() -> int:
-    """
-    Returns the current unix timestamp in the UTC timezone.
-    """
-    return calendar.timegm(datetime.datetime.utcnow().timetuple())
 
+@app.teardown_appcontext
+def close_mysql(exception: Optional[BaseException]) -> None:
+    global config
+
+    if g.pop('_db', None) is not None:
+        cast(Data, config['database']['data']).release()
 
-def modified(fname: str) -> int:
+
+def now() -> int:
     """
-    Returns the modification time in the UTC timezone.
+    Returns the current unix timestamp in the UTC timezone.
     """
-    return calendar.timegm(datetime.datetime.utcfromtimestamp(os.path.getmtime(fname)).timetuple())
+    return int(time.time())
 
 
 def first_quality() -> Optional[str]:
@@ -64,6 +144,8 @@ def first_quality() -> Optional[str]:
 
 
 class SocketInfo:
+    __slots__ = ('sid', 'ip', 'streamer', 'username', 'admin', 'moderator', 'muted', 'color', 'htmlcolor')
+
     def __init__(self, sid: Any, ip: str, streamer: str, username: str, admin: bool, moderator: bool, muted: bool, color: int) -> None:
         self.sid = sid
         self.ip = ip
@@ -73,71 +155,168 @@ class SocketInfo:
         self.moderator = moderator
         self.muted = muted
         self.color = color
-
-    @property
-    def htmlcolor(self) -> str:
-        color = hex(self.color)[2:]
-        if len(color) < 6:
-            color = ('0' * (6 - len(color))) + color
-        return '#' + color
+        self.htmlcolor = '#%06x' % color
 
 
 class PresenceInfo:
+    __slots__ = ('sid', 'streamer', 'timestamp')
+
     def __init__(self, sid: Any, streamer: str) -> None:
         self.sid = sid
         self.streamer = streamer
-        self.timestamp = now()
+        # Only ever compared against other presence timestamps, so use the cheaper clock
+        # that also can't jump around with wall time.
+        self.timestamp = time.monotonic()
 
 
 socket_to_info: Dict[Any, SocketInfo] = {}
 socket_to_presence: Dict[Any, PresenceInfo] = {}
+_m3u8_cache: Dict[Tuple[str, Optional[str]], Tuple[int, str]] = {}
+_neg_stat: Dict[str, int] = {}
+_last_clean: float = 0.0
+_streamer_cache: Dict[str, Tuple[int, Dict[str, Any]]] = {}
+_emotes_cache: Tuple[int, Dict[str, str]] = (0, {})
+# Serializes admin and moderation changes within a single stream, without holding up
+# any other stream's chat.
+_streamer_locks: DefaultDict[str, Semaphore] = defaultdict(Semaphore)
+
+# Per-streamer indexes of the above, so that room lookups only touch the sockets
+# in that room instead of every socket on the server. Users are keyed by their
+# lowercased name, in the order that they joined.
+users_by_streamer: DefaultDict[str, Dict[str, SocketInfo]] = defaultdict(dict)
+streamer_to_presence_sids: DefaultDict[str, Set[Any]] = defaultdict(set)
+
+
+def find_user(streamer: str, username: str) -> Optional[SocketInfo]:
+    return users_by_streamer.get(streamer, {}).get(username.lower())
+
+
+def name_taken(streamer: str, username: str) -> bool:
+    return username.lower() in users_by_streamer.get(streamer, {})
+
+
+def add_user(info: SocketInfo) -> None:
+    socket_to_info[info.sid] = info
+    users_by_streamer[info.streamer][info.username.lower()] = info
+
+
+def rename_user(info: SocketInfo, username: str) -> None:
+    # Renames are rare, so rebuild the room to keep everybody in join order.
+    old = info.username.lower()
+    new = username.lower()
+    room = users_by_streamer[info.streamer]
+    users_by_streamer[info.streamer] = {(new if name == old else name): user for name, user in room.items()}
+    info.username = username
+
+
+def remove_user(sid: Any) -> Optional[SocketInfo]:
+    info = socket_to_info.pop(sid, None)
+    if info is not None:
+        room = users_by_streamer.get(info.streamer)
+        if room is not None:
+            room.pop(info.username.lower(), None)
+            if not room:
+                del users_by_streamer[info.streamer]
+    return info
+
+
+def update_presence(sid: Any, streamer: str) -> None:
+    old = socket_to_presence.get(sid)
+    if old is not None:
+        if old.streamer == streamer:
+            # Presence is refreshed on every ping and chat message, so don't churn objects.
+            old.timestamp = time.monotonic()
+            return
+        remove_presence(sid)
+    socket_to_presence[sid] = PresenceInfo(sid, streamer)
+    streamer_to_presence_sids[streamer].add(sid)
+
+
+def remove_presence(sid: Any) -> None:
+    presence = socket_to_presence.pop(sid, None)
+    if presence is not None:
+        sids = streamer_to_presence_sids.get(presence.streamer)
+        if sids is not None:
+            sids.discard(sid)
+            if not sids:
+                del streamer_to_presence_sids[presence.streamer]
 
 
 def users_in_room(streamer: str) -> List[Dict[str, str]]:
-    return [{'username': i.username, 'type': get_type(i), 'color': i.htmlcolor} for i in socket_to_info.values() if i.streamer == streamer]
+    return [{'username': i.username, 'type': get_type(i), 'color': i.htmlcolor} for i in users_by_streamer.get(streamer, {}).values()]
 
 
 def stream_count(streamer: str) -> int:
-    oldest = now() - 30
-    return len([None for x in socket_to_presence.values() if x.streamer == streamer and x.timestamp >= oldest])
-
+    oldest = time.monotonic() - 30
+    return len([None for sid in streamer_to_presence_sids.get(streamer, ()) if socket_to_presence[sid].timestamp >= oldest])
 
-def stream_live(streamkey: str, quality: Optional[str] = None) -> bool:
-    global config
 
+def playlist_path(streamkey: str, quality: Optional[str] = None) -> str:
     if quality:
-        filename = f"{streamkey}_{quality}.m3u8"
+        return f"{HLS_DIR}/{streamkey}_{quality}.m3u8"
     else:
-        filename = streamkey + '.m3u8'
-    m3u8 = os.path.join(config['hls_dir'], filename)
-    if not os.path.isfile(m3u8):
+        return f"{HLS_DIR}/{streamkey}.m3u8"
+
+
+def _stat_playlist(streamkey: str, quality: Optional[str] = None) -> Optional[os.stat_result]:
+    m3u8 = playlist_path(streamkey, quality)
+
+    # Most streamers are offline most of the time, so remember misses for a short
+    # while instead of statting a file we just found to be missing.
+    missing = _neg_stat.get(m3u8)
+    if missing is not None and now() - missing < 2:
+        return None
+
+    try:
+        stat = os.stat(m3u8)
+    except OSError:
         # There isn't a playlist file, we aren't live.
-        return False
+        if len(_neg_stat) >= 1024:
+            # Drop the oldest half so this can't grow without bound.
+            for old in list(_neg_stat)[:len(_neg_stat) // 2]:
+                del _neg_stat[old]
+        _neg_stat.pop(m3u8, None)
+        _neg_stat[m3u8] = now()
+        return None
+
+    _neg_stat.pop(m3u8, None)
+    return stat
+
 
-    delta = now() - modified(m3u8)
-    if delta >= int(config['hls_playlist_length']):
+def _playlist_live(mtime: int) -> bool:
+    delta = now() - mtime
+    if delta >= HLS_TTL:
         return False
 
     return True
 
 
+def stream_live(streamkey: str, quality: Optional[str] = None) -> bool:
+    stat = _stat_playlist(streamkey, quality)
+    if stat is None:
+        return False
+    return _playlist_live(int(stat.st_mtime))
+
+
 def get_color(color: str) -> Optional[int]:
     color = color.strip().lower()
 
     if color == "random":
         # Pick a random webcolor.
-        choices = [k for k in webcolors.CSS3_NAMES_TO_HEX]
-        color = random.choice(choices)
+        color = random.choice(_CSS3_NAMES)
 
-    # Attempt to convert from any color specification to hex.
+    # Attempt to convert from any color specification to hex. A successful name
+    # lookup is already normalized, so only normalize things that weren't names.
     try:
         color = webcolors.name_to_hex(color, spec=webcolors.CSS3)
+        matched = True
     except ValueError:
-        pass
-    try:
-        color = webcolors.normalize_hex(color)
-    except ValueError:
-        pass
+        matched = False
+    if not matched:
+        try:
+            color = webcolors.normalize_hex(color)
+        except ValueError:
+            pass
 
     if len(color) != 7 or color[0] != '#':
         return None
@@ -158,37 +337,54 @@ def get_type(user: SocketInfo) -> str:
         return "normal"
 
 
-def fetch_m3u8(streamkey: str, quality: Optional[str] = None) -> Optional[str]:
-    global config
-
-    if quality:
-        filename = f"{streamkey}_{quality}"
-    else:
-        filename = streamkey
-    m3u8 = os.path.join(config['hls_dir'], filename) + '.m3u8'
-    if not os.path.isfile(m3u8):
+def _open_playlist(streamkey: str, quality: Optional[str] = None) -> Optional[Tuple[str, int]]:
+    """
+    Returns the contents of a playlist along with its modification time, or None if
+    there is no playlist. The file is only looked up by name once, with the stat
+    and the read both going through the same descriptor.
+    """
+    try:
+        fd = os.open(playlist_path(streamkey, quality), os.O_RDONLY | os.O_CLOEXEC)
+    except FileNotFoundError:
         # There isn't a playlist file, we aren't live.
         return None
 
-    with open(m3u8, "rb") as bfp:
-        return bfp.read().decode('utf-8')
+    try:
+        stat = os.fstat(fd)
 
+        # Clients poll the playlist far more often than nginx rewrites it, so only
+        # read it again when the modification time has changed.
+        cachekey = (streamkey, quality)
+        cached = _m3u8_cache.get(cachekey)
+        if cached is None or cached[0] != stat.st_mtime_ns:
+            data = os.read(fd, stat.st_size).decode('utf-8')
+            cached = (stat.st_mtime_ns, data)
+            _m3u8_cache[cachekey] = cached
+    finally:
+        os.close(fd)
 
-def fetch_ts(filename: str) -> Optional[bytes]:
-    global config
+    return cached[1], int(stat.st_mtime)
 
-    ts = os.path.join(config['hls_dir'], filename)
-    if not os.path.isfile(ts):
-        # The file doesn't exist
-        return None
 
-    with open(ts, "rb") as bfp:
-        return bfp.read()
+def rewrite_playlist(m3u8: str, key: str, oldprefix: str, newprefix: str) -> str:
+    """
+    Points every segment in a playlist at a symlink named after the streamer instead
+    of the stream key, so that the key is never handed out to viewers.
+    """
+    def rewrite(match: Match[str]) -> str:
+        newname = newprefix + match.group(1)
+        symlink(match.group(0), newname)
+        return "/hls/" + newname
+
+    m3u8 = re.sub("^" + re.escape(oldprefix) + r"(.*\.ts)(?=\r?$)", rewrite, m3u8, flags=re.MULTILINE)
+    if key in m3u8:
+        raise Exception("Possible stream key leak!")
+    return m3u8
 
 
 def symlink(oldname: str, newname: str) -> None:
-    src = os.path.join(config['hls_dir'], oldname)
-    dst = os.path.join(config['hls_dir'], newname)
+    src = f"{HLS_DIR}/{oldname}"
+    dst = f"{HLS_DIR}/{newname}"
     try:
         os.symlink(src, dst)
     except FileExistsError:
@@ -196,24 +392,78 @@ def symlink(oldname: str, newname: str) -> None:
 
 
 def clean_symlinks() -> None:
-    global config
+    global _last_clean
+
+    # Every viewer polls the playlist every few seconds, but nginx only expires old
+    # segments every so often, so there's no point walking the whole directory on
+    # every request.
+    current = time.monotonic()
+    if current - _last_clean < 30:
+        return
+    _last_clean = current
 
     try:
-        for name in os.listdir(config['hls_dir']):
-            if name not in (os.curdir, os.pardir):
-                full = os.path.join(config['hls_dir'], name)
-                if os.path.islink(full):
-                    real = os.readlink(full)
-                    if not os.path.isfile(real):
-                        # This symlink points at an old file that nginx has removed.
-                        # So, let's clean up!
-                        os.remove(full)
+        with os.scandir(HLS_DIR) as entries:
+            for entry in entries:
+                # The file type comes from the directory listing itself, so only
+                # symlinks cost us a stat to see if they still point anywhere.
+                if entry.is_symlink() and not entry.is_file():
+                    # This symlink points at an old file that nginx has removed.
+                    # So, let's clean up!
+                    os.remove(entry.path)
     except Exception:
         # We don't want to interrupt playlist fetching due to a failure to
         # clean. If this happens the stream will pause.
         pass
 
 
+def get_streamer(username: str) -> Optional[Dict[str, Any]]:
+    """
+    Looks up a streamer's settings, or returns None if the streamer doesn't exist.
+    Viewers hit this on every playlist poll, so rows are kept around for a few
+    seconds rather than asking the DB every time.
+    """
+    username = username.lower()
+    cached = _streamer_cache.get(username)
+    if cached is not None and now() - cached[0] < 5:
+        return cached[1]
+
+    cursor = mysql().execute(
+        "SELECT `username`, `key`, `description`, `streampass` FROM streamersettings WHERE username = :username",
+        {"username": username},
+    )
+    if cursor.rowcount != 1:
+        _streamer_cache.pop(username, None)
+        return None
+
+    result = dict(cursor.fetchone())
+    _streamer_cache[username] = (now(), result)
+    return result
+
+
+def invalidate_streamer(username: str) -> None:
+    _streamer_cache.pop(username.lower(), None)
+
+
+def get_emotes() -> Dict[str, str]:
+    """
+    Returns custom emotes keyed by their ":alias:" form. These only change when
+    somebody runs manage.py, so hold onto them for a little while.
+    """
+    global _emotes_cache
+
+    timestamp, emotes = _emotes_cache
+    if now() - timestamp < 30:
+        return emotes
+
+    cursor = mysql().execute(
+        "SELECT alias, uri FROM emotes ORDER BY alias",
+    )
+    emotes = {f":{result['alias']}:": result['uri'] for result in cursor.fetchall()}
+    _emotes_cache = (now(), emotes)
+    return emotes
+
+
 @app.context_processor
 def provide_globals() -> Dict[str, Any]:
     return {
@@ -230,7 +480,7 @@ def index() -> str:
         {
             'username': result['username'],
             'live': stream_live(result['key'], first_quality()), 'count': stream_count(result['username'].lower()),
-            'description': emotes(result['description']) if result['description'] else '',
+            'description': description_emotes(result['description']) if result['description'] else '',
             'locked': result['streampass'] is not None,
         }
         for result in cursor.fetchall()
@@ -240,15 +490,10 @@ def index() -> str:
 
 @app.route('/<streamer>/')
 def stream(streamer: str) -> Response:
-    cursor = mysql().execute(
-        "SELECT username, streampass FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
+    result = get_streamer(streamer)
+    if result is None:
         abort(404)
 
-    result = cursor.fetchone()
-
     streampass = result['streampass']
     if streampass is not None and request.cookies.get('streampass') != streampass:
         # This stream is password protected!
@@ -268,16 +513,6 @@ def stream(streamer: str) -> Response:
     else:
         playlists = [{"src": url_for('streamplaylistwithquality', streamer=streamer, quality=quality), "label": quality, "type": "application/x-mpegURL"} for quality in qualities]
 
-    emojis = {
-        **emoji.get_emoji_unicode_dict('en'),  # type: ignore
-        **emoji.get_aliases_unicode_dict(),  # type: ignore
-    }
-    emojis = {key: emojis[key] for key in emojis if "__" not in key}
-
-    cursor = mysql().execute(
-        "SELECT alias, uri FROM emotes ORDER BY alias",
-    )
-    emotes = {f":{result['alias']}:": result['uri'] for result in cursor.fetchall()}
     icons = {
         'admin': url_for('static', filename='admin.png'),
         'moderator': url_for('static', filename='moderator.png'),
@@ -288,8 +523,8 @@ def stream(streamer: str) -> Response:
             'stream.html',
             streamer=result["username"],
             playlists=playlists,
-            emojis=emojis,
-            emotes=emotes,
+            emojis=_EMOJIS,
+            emotes=get_emotes(),
             icons=icons,
         )
     )
@@ -298,15 +533,11 @@ def stream(streamer: str) -> Response:
 @app.route('/<streamer>/password', methods=["POST"])
 def password(streamer: str) -> Response:
     streamer = streamer.lower()
-    cursor = mysql().execute(
-        "SELECT `username`, `streampass` FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
+    result = get_streamer(streamer)
+    if result is None:
         abort(404)
 
     # Verify the password.
-    result = cursor.fetchone()
     streampass = result['streampass']
     if request.form.get('streampass') == streampass:
         expire_date = datetime.datetime.now()
@@ -330,18 +561,13 @@ def password(streamer: str) -> Response:
 def streaminfo(streamer: str) -> Response:
     streamer = streamer.lower()
 
-    cursor = mysql().execute(
-        "SELECT `username`, `streampass`, `key`, `description` FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
+    result = get_streamer(streamer)
+    if result is None:
         abort(404)
 
     # Doesn't cost us much, so let's clean up on the fly.
     clean_symlinks()
 
-    result = cursor.fetchone()
-
     # First, verify they're even allowed to see this stream.
     streampass = result['streampass']
     if streampass is not None and request.cookies.get('streampass') != streampass:
@@ -353,7 +579,7 @@ def streaminfo(streamer: str) -> Response:
     return make_response(jsonify({
         'live': live,
         'count': stream_count(streamer) if live else 0,
-        'description': emotes(result['description']) if result['description'] else '',
+        'description': description_emotes(result['description']) if result['description'] else '',
     }))
 
 
@@ -361,15 +587,10 @@ def streaminfo(streamer: str) -> Response:
 def streamplaylist(streamer: str) -> str:
     streamer = streamer.lower()
 
-    cursor = mysql().execute(
-        "SELECT `username`, `streampass`, `key` FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
+    result = get_streamer(streamer)
+    if result is None:
         abort(404)
 
-    result = cursor.fetchone()
-
     # First ensure they're even allowed to see this stream.
     streampass = result['streampass']
     if streampass is not None and request.cookies.get('streampass') != streampass:
@@ -379,28 +600,19 @@ def streamplaylist(streamer: str) -> str:
     # The stream is either not password protected, or the user has already authenticated.
     key = result['key']
 
-    if not stream_live(key):
+    playlist = _open_playlist(key)
+    if playlist is None:
         abort(404)
 
-    m3u8 = fetch_m3u8(key)
-    if m3u8 is None:
+    m3u8, mtime = playlist
+    if not _playlist_live(mtime):
         abort(404)
 
-    lines = m3u8.splitlines()
-    for i in range(len(lines)):
-        if lines[i].startswith(key) and lines[i][-3:] == ".ts":
-            # We need to rewrite this
-            oldname = lines[i]
-            newname = f"{streamer}" + lines[i][len(key):]
-            symlink(oldname, newname)
-            lines[i] = "/hls/" + newname
-        if key in lines[i]:
-            raise Exception("Possible stream key leak!")
+    m3u8 = rewrite_playlist(m3u8, key, key, streamer)
 
     # Doesn't cost us much, so let's clean up on the fly.
     clean_symlinks()
 
-    m3u8 = "\n".join(lines)
     return m3u8
 
 
@@ -408,15 +620,10 @@ def streamplaylist(streamer: str) -> str:
 def streamplaylistwithquality(streamer: str, quality: str) -> str:
     streamer = streamer.lower()
 
-    cursor = mysql().execute(
-        "SELECT `username`, `streampass`, `key` FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
+    result = get_streamer(streamer)
+    if result is None:
         abort(404)
 
-    result = cursor.fetchone()
-
     # First ensure they're even allowed to see this stream.
     streampass = result['streampass']
     if streampass is not None and request.cookies.get('streampass') != streampass:
@@ -426,41 +633,28 @@ def streamplaylistwithquality(streamer: str, quality: str) -> str:
     # The stream is either not password protected, or the user has already authenticated.
     key = result['key']
 
-    if not stream_live(key, quality):
+    playlist = _open_playlist(key, quality)
+    if playlist is None:
         abort(404)
 
-    m3u8 = fetch_m3u8(key, quality)
-    if m3u8 is None:
+    m3u8, mtime = playlist
+    if not _playlist_live(mtime):
         abort(404)
 
-    lines = m3u8.splitlines()
-    for i in range(len(lines)):
-        if lines[i].startswith(key + '_' + quality) and lines[i][-3:] == ".ts":
-            # We need to rewrite this
-            oldname = lines[i]
-            newname = f"{streamer}_{quality}" + lines[i][(len(key) + len(quality) + 1):]
-            symlink(oldname, newname)
-            lines[i] = "/hls/" + newname
-        if key in lines[i]:
-            raise Exception("Possible stream key leak!")
+    m3u8 = rewrite_playlist(m3u8, key, f"{key}_{quality}", f"{streamer}_{quality}")
 
     # Doesn't cost us much, so let's clean up on the fly.
     clean_symlinks()
 
-    m3u8 = "\n".join(lines)
     return m3u8
 
 
 @app.route('/hls/<filename>')
 def streamts(filename: str) -> Response:
     # This is a debugging endpoint only, your production nginx setup should handle this.
-    ts = fetch_ts(filename)
-    if ts is None:
-        abort(404)
-
-    response = make_response(ts)
-    response.headers.set('Content-Type', 'video/mp2t')  # type: ignore
-    return response
+    # Hand the file off to the WSGI server rather than reading it ourselves so that it
+    # can use its file wrapper, and let clients revalidate segments they already have.
+    return send_from_directory(HLS_DIR, filename, mimetype='video/mp2t', conditional=True)
 
 
 @app.route('/auth/on_publish', methods=["GET", "POST"])
@@ -489,19 +683,15 @@ def donepublishcheck() -> Response:
 
 @socketio.on('connect')  # type: ignore
 def connect() -> None:
-    if request.sid in socket_to_info:
-        del socket_to_info[request.sid]
+    remove_user(request.sid)
 
 
 @socketio.on('disconnect')  # type: ignore
 def disconnect() -> None:
-    if request.sid in socket_to_info:
-        info = socket_to_info[request.sid]
-        del socket_to_info[request.sid]
-
-        socketio.emit('disconnected', {'username': info.username, 'type': get_type(info), 'color': info.htmlcolor, 'users': users_in_room(info.streamer)}, room=info.streamer)
-    if request.sid in socket_to_presence:
-        del socket_to_presence[request.sid]
+    info = remove_user(request.sid)
+    if info is not None:
+        socketio.emit('disconnected', {'username': info.username, 'type': get_type(info), 'color': info.htmlcolor}, to=info.streamer)
+    remove_presence(request.sid)
 
 
 @socketio.on('presence')  # type: ignore
@@ -511,613 +701,595 @@ def handle_presence(json: Dict[str, Any], methods: List[str] = ['GET', 'POST'])
 
     # Update user presence information
     streamer = json['streamer'].lower()
-    socket_to_presence[request.sid] = PresenceInfo(request.sid, streamer)
+    update_presence(request.sid, streamer)
 
 
 @socketio.on('login')  # type: ignore
 def handle_login(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -> None:
     if request.sid in socket_to_info:
-        socketio.emit('error', {'msg': 'SID already taken?'}, room=request.sid)
+        socketio.emit('error', {'msg': 'SID already taken?'}, to=request.sid)
         return
 
     if 'username' not in json:
-        socketio.emit('error', {'msg': 'Username mssing from JSON?'}, room=request.sid)
+        socketio.emit('error', {'msg': 'Username mssing from JSON?'}, to=request.sid)
         return
 
     if 'streamer' not in json:
-        socketio.emit('error', {'msg': 'Streamer mssing from JSON?'}, room=request.sid)
+        socketio.emit('error', {'msg': 'Streamer mssing from JSON?'}, to=request.sid)
         return
 
     if len(json['username']) == 0:
-        socketio.emit('error', {'msg': 'Username cannot be blank'}, room=request.sid)
+        socketio.emit('error', {'msg': 'Username cannot be blank'}, to=request.sid)
         return
 
     if len(json['username']) >= 30:
-        socketio.emit('error', {'msg': 'Username cannot be that long'}, room=request.sid)
+        socketio.emit('error', {'msg': 'Username cannot be that long'}, to=request.sid)
         return
 
     streamer = json['streamer'].lower()
     username = json['username']
 
-    for user in users_in_room(streamer):
-        if user['username'].lower() == username.lower():
-            socketio.emit('error', {'msg': 'Username is already taken'}, room=request.sid)
-            return
+    if name_taken(streamer, username):
+        socketio.emit('error', {'msg': 'Username is already taken'}, to=request.sid)
+        return
 
     color = get_color(json['color'].strip().lower()) or 0
     key = json.get('key', None)
 
     # Update user presence information
-    socket_to_presence[request.sid] = PresenceInfo(request.sid, streamer)
+    update_presence(request.sid, streamer)
 
-    cursor = mysql().execute(
-        "SELECT `username`, `key` FROM streamersettings WHERE username = :username",
-        {"username": streamer},
-    )
-    if cursor.rowcount != 1:
-        socketio.emit('error', {'msg': 'Streamer does not exist'}, room=request.sid)
+    result = get_streamer(streamer)
+    if result is None:
+        socketio.emit('error', {'msg': 'Streamer does not exist'}, to=request.sid)
         return
 
     admin = False
     if username.lower() == streamer:
-        result = cursor.fetchone()
-
         if key is None:
-            socketio.emit('login key required', {'username': result['username']}, room=request.sid)
+            socketio.emit('login key required', {'username': result['username']}, to=request.sid)
             return
 
         if key != result["key"]:
-            socketio.emit('error', {'msg': 'Invalid password!'}, room=request.sid)
+            socketio.emit('error', {'msg': 'Invalid password!'}, to=request.sid)
             return
 
         username = result['username']
         admin = True
 
-    for _, existing in socket_to_info.items():
-        if existing.streamer != streamer:
-            # Not the right room
-            continue
-
-        if existing.username.lower() == json['username'].lower():
-            socketio.emit('error', {'msg': 'Username is taken'}, room=request.sid)
-            return
+    # Somebody else may have taken the name while we were talking to the DB.
+    if name_taken(streamer, json['username']):
+        socketio.emit('error', {'msg': 'Username is taken'}, to=request.sid)
+        return
 
-    socket_to_info[request.sid] = SocketInfo(request.sid, str(request.remote_addr), streamer, json['username'], admin, False, False, color)
+    info = SocketInfo(request.sid, str(request.remote_addr), streamer, json['username'], admin, False, False, color)
+    add_user(info)
     join_room(streamer)
-    socketio.emit('login success', {'username': json['username']}, room=request.sid)
-    socketio.emit('connected', {'username': json['username'], 'type': get_type(socket_to_info[request.sid]), 'color': socket_to_info[request.sid].htmlcolor, 'users': users_in_room(streamer)}, room=streamer)
+    # Only the newly joined user gets the full user list, everybody else patches their
+    # copy from the join, leave and rename events instead.
+    socketio.emit('login success', {'username': json['username'], 'users': users_in_room(streamer)}, to=request.sid)
+    socketio.emit('connected', {'username': info.username, 'type': get_type(info), 'color': info.htmlcolor}, to=streamer)
 
     if admin:
-        socketio.emit('server', {'msg': 'You have admin rights.'}, room=request.sid)
+        socketio.emit('server', {'msg': 'You have admin rights.'}, to=request.sid)
 
 
 def emotes(msg: str) -> str:
-    return emoji.emojize(emoji.emojize(msg, language="alias"), language="en")
+    return _EMOJI_RE.sub(lambda m: _EMOJI_MAP.get(m.group(0), m.group(0)), msg)
 
 
-@socketio.on('message')  # type: ignore
-def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -> None:
-    if 'message' not in json:
-        socketio.emit('error', {'msg': 'Message mssing from JSON?'}, room=request.sid)
-        return
+@functools.lru_cache(maxsize=None)
+def description_emotes(description: str) -> str:
+    # Unlike chat, descriptions are rendered over and over on the index and on every
+    # info poll while rarely changing, so the substitution is worth remembering. There
+    # is only a handful per streamer, and the index walks all of them at once, so don't
+    # let a size limit evict entries before the next page load gets to reuse them.
+    return emotes(description)
 
-    if len(json['message']) == 0:
-        socketio.emit('warning', {'msg': 'Message cannot be blank'}, room=request.sid)
-        return
 
-    if request.sid not in socket_to_info:
-        socketio.emit('error', {'msg': 'User is not authenticated?'}, room=request.sid)
-        return
+# Chat command handlers take the info of the user who sent the command and the rest
+# of the message after the command.
+CommandHandler = Callable[[SocketInfo, str], None]
 
-    # Update user presence information
-    socket_to_presence[request.sid] = PresenceInfo(request.sid, socket_to_info[request.sid].streamer)
+# Decides whether the user who sent a command is allowed to run it.
+CommandPermission = Callable[[SocketInfo], bool]
 
-    message = json['message'].strip()
-    if message[0] == "/":
-        # Command of some sort
-        if ' ' in message:
-            command, message = message.split(' ', 1)
+
+def _anyone(info: SocketInfo) -> bool:
+    return True
+
+
+def _moderators(info: SocketInfo) -> bool:
+    return info.admin or info.moderator
+
+
+def _admins(info: SocketInfo) -> bool:
+    return info.admin
+
+
+def unmuted(handler: CommandHandler) -> CommandHandler:
+    """
+    Wraps a command that speaks in chat so that muted users are told so instead.
+    """
+    @functools.wraps(handler)
+    def wrapper(info: SocketInfo, message: str) -> None:
+        if info.muted:
+            socketio.emit(
+                'server',
+                {'msg': "You are muted!"},
+                to=info.sid,
+            )
         else:
-            command = message
-            message = ""
+            handler(info, message)
+    return wrapper
+
+
+@unmuted
+def _cmd_say(info: SocketInfo, message: str) -> None:
+    # Just a say message
+    socketio.emit(
+        'message received',
+        {
+            'username': info.username,
+            'type': get_type(info),
+            'color': info.htmlcolor,
+            'message': emotes(message),
+        },
+        to=info.streamer,
+    )
+
+
+@unmuted
+def _cmd_action(info: SocketInfo, message: str) -> None:
+    # An action message
+    socketio.emit(
+        'action received',
+        {
+            'username': info.username,
+            'type': get_type(info),
+            'color': info.htmlcolor,
+            'message': emotes(message),
+        },
+        to=info.streamer,
+    )
+
+
+@unmuted
+def _cmd_color(info: SocketInfo, message: str) -> None:
+    # Set the color of your name
+    color = get_color(message.strip().lower())
+
+    if not color:
+        socketio.emit(
+            'server',
+            {'msg': f'Invalid color {message} specified, try a color name, an HTML color like #ff00ff or "random" for a random color.'},
+            to=info.sid,
+        )
+    else:
+        info.color = color
+        info.htmlcolor = '#%06x' % color
+        socketio.emit(
+            'action received',
+            {
+                'username': info.username,
+                'type': get_type(info),
+                'color': info.htmlcolor,
+                'message': 'changed their color!',
+            },
+            to=info.streamer,
+        )
+        socketio.emit(
+            'return color',
+            {'color': info.htmlcolor},
+            to=info.sid,
+        )
+
 
-        if command in ["/say"]:
-            if socket_to_info[request.sid].muted:
-                socketio.emit(
-                    'server',
-                    {'msg': "You are muted!"},
-                    room=request.sid,
-                )
-            else:
-                # Just a say message
-                socketio.emit(
-                    'message received',
-                    {
-                        'username': socket_to_info[request.sid].username,
-                        'type': get_type(socket_to_info[request.sid]),
-                        'color': socket_to_info[request.sid].htmlcolor,
-                        'message': emotes(message),
-                    },
-                    room=socket_to_info[request.sid].streamer,
-                )
-        elif command in ["/me", "/action", "/describe"]:
-            if socket_to_info[request.sid].muted:
-                socketio.emit(
-                    'server',
-                    {'msg': "You are muted!"},
-                    room=request.sid,
-                )
-            else:
-                # An action message
-                socketio.emit(
-                    'action received',
-                    {
-                        'username': socket_to_info[request.sid].username,
-                        'type': get_type(socket_to_info[request.sid]),
-                        'color': socket_to_info[request.sid].htmlcolor,
-                        'message': emotes(message),
-                    },
-                    room=socket_to_info[request.sid].streamer,
-                )
-        elif command in ["/color", "/setcolor"]:
-            if socket_to_info[request.sid].muted:
-                socketio.emit(
-                    'server',
-                    {'msg': "You are muted!"},
-                    room=request.sid,
-                )
-            else:
-                # Set the color of your name
-                color = get_color(message.strip().lower())
-
-                if not color:
-                    socketio.emit(
-                        'server',
-                        {'msg': f'Invalid color {message} specified, try a color name, an HTML color like #ff00ff or "random" for a random color.'},
-                        room=request.sid,
-                    )
-                else:
-                    socket_to_info[request.sid].color = color
-                    socketio.emit(
-                        'action received',
-                        {
-                            'username': socket_to_info[request.sid].username,
-                            'type': get_type(socket_to_info[request.sid]),
-                            'color': socket_to_info[request.sid].htmlcolor,
-                            'message': 'changed their color!',
-                        },
-                        room=socket_to_info[request.sid].streamer,
-                    )
-                    socketio.emit(
-                        'return color',
-                        {'color': socket_to_info[request.sid].htmlcolor},
-                        room=request.sid,
-                    )
-        elif command in ["/name", "/nick"]:
-            if socket_to_info[request.sid].muted:
-                socketio.emit(
-                    'server',
-                    {'msg': "You are muted!"},
-                    room=request.sid,
-                )
-            else:
-                # Set a new name
-                name = message.strip()
-
-                if len(name) >= 30:
-                    socketio.emit(
-                        'server',
-                        {'msg': 'Too long of a name specified, try a different name.'},
-                        room=request.sid,
-                    )
-                else:
-                    for user in users_in_room(socket_to_info[request.sid].streamer):
-                        if user['username'].lower() == name.lower():
-                            socketio.emit(
-                                'server',
-                                {'msg': 'Name has already been taken, try a different name.'},
-                                room=request.sid,
-                            )
-                            break
-                    else:
-                        if not name:
-                            socketio.emit(
-                                'server',
-                                {'msg': 'Invalid name specified, try a different name.'},
-                                room=request.sid,
-                            )
-                        else:
-                            old = socket_to_info[request.sid].username
-                            socket_to_info[request.sid].username = name
-                            socketio.emit(
-                                'rename',
-                                {
-                                    'newname': socket_to_info[request.sid].username,
-                                    'oldname': old,
-                                    'type': get_type(socket_to_info[request.sid]),
-                                    'color': socket_to_info[request.sid].htmlcolor,
-                                    'users': users_in_room(socket_to_info[request.sid].streamer),
-                                },
-                                room=socket_to_info[request.sid].streamer,
-                            )
-        elif command in ["/help"]:
-            messages = [
-                "The following commands are recognized:",
-                "/help - show this message",
-                "/users - show the currently chatting users",
-                "/me - perform an action",
-                "/color - set the color of your name in chat",
-                "/name - change your name to a new one",
-            ]
-            if socket_to_info[request.sid].admin:
-                messages.append("/settings - display all stream settings")
-                messages.append("/description <text> - set the stream description")
-                messages.append("/password [<text>] - set or unset the stream password")
-                messages.append("/mod <user> - grant moderator privileges to user")
-                messages.append("/demod <user> - revoke moderator privileges to user")
-            if socket_to_info[request.sid].admin or socket_to_info[request.sid].moderator:
-                messages.append("/mute <user> - mute user")
-                messages.append("/unmute <user> - unmute user")
-
-            for message in messages:
-                socketio.emit(
-                    'server',
-                    {'msg': message},
-                    room=request.sid,
-                )
-        elif command in ["/users"]:
+@unmuted
+def _cmd_name(info: SocketInfo, message: str) -> None:
+    # Set a new name
+    name = message.strip()
+
+    if len(name) >= 30:
+        socketio.emit(
+            'server',
+            {'msg': 'Too long of a name specified, try a different name.'},
+            to=info.sid,
+        )
+    elif name_taken(info.streamer, name):
+        socketio.emit(
+            'server',
+            {'msg': 'Name has already been taken, try a different name.'},
+            to=info.sid,
+        )
+    elif not name:
+        socketio.emit(
+            'server',
+            {'msg': 'Invalid name specified, try a different name.'},
+            to=info.sid,
+        )
+    else:
+        old = info.username
+        rename_user(info, name)
+        socketio.emit(
+            'rename',
+            {
+                'newname': info.username,
+                'oldname': old,
+                'type': get_type(info),
+                'color': info.htmlcolor,
+            },
+            to=info.streamer,
+        )
+
+
+def _cmd_help(info: SocketInfo, message: str) -> None:
+    messages = [
+        "The following commands are recognized:",
+        "/help - show this message",
+        "/users - show the currently chatting users",
+        "/me - perform an action",
+        "/color - set the color of your name in chat",
+        "/name - change your name to a new one",
+    ]
+    if info.admin:
+        messages.append("/settings - display all stream settings")
+        messages.append("/description <text> - set the stream description")
+        messages.append("/password [<text>] - set or unset the stream password")
+        messages.append("/mod <user> - grant moderator privileges to user")
+        messages.append("/demod <user> - revoke moderator privileges to user")
+    if info.admin or info.moderator:
+        messages.append("/mute <user> - mute user")
+        messages.append("/unmute <user> - unmute user")
+
+    for message in messages:
+        socketio.emit(
+            'server',
+            {'msg': message},
+            to=info.sid,
+        )
+
+
+def _cmd_users(info: SocketInfo, message: str) -> None:
+    socketio.emit(
+        'userlist',
+        {'users': users_in_room(info.streamer)},
+        to=info.sid,
+    )
+
+
+def _cmd_settings(info: SocketInfo, message: str) -> None:
+    result = get_streamer(info.streamer)
+    if result is None:
+        socketio.emit(
+            'server',
+            {'msg': "Error looking up settings!"},
+            to=info.sid,
+        )
+    else:
+        socketio.emit(
+            'server',
+            {'msg': f"Description: {result['description']}"},
+            to=info.sid,
+        )
+        if result['streampass']:
             socketio.emit(
-                'userlist',
-                {'users': users_in_room(socket_to_info[request.sid].streamer)},
-                room=request.sid,
+                'server',
+                {'msg': f"Stream password: {result['streampass']}"},
+                to=info.sid,
             )
-        elif command in ["/settings"]:
-            if not socket_to_info[request.sid].admin:
-                socketio.emit(
-                    'server',
-                    {'msg': f"Unrecognized command '{command}', use '/help' for info."},
-                    room=request.sid,
-                )
-                return
-
-            streamer = socket_to_info[request.sid].streamer
-            cursor = mysql().execute(
-                "SELECT `description`, `streampass` FROM streamersettings WHERE `username` = :streamer",
-                {"streamer": streamer}
+        else:
+            socketio.emit(
+                'server',
+                {'msg': "No stream password"},
+                to=info.sid,
             )
-            if cursor.rowcount != 1:
-                socketio.emit(
-                    'server',
-                    {'msg': "Error looking up settings!"},
-                    room=request.sid,
-                )
-            else:
-                result = cursor.fetchone()
-                socketio.emit(
-                    'server',
-                    {'msg': f"Description: {result['description']}"},
-                    room=request.sid,
-                )
-                if result['streampass']:
-                    socketio.emit(
-                        'server',
-                        {'msg': f"Stream password: {result['streampass']}"},
-                        room=request.sid,
-                    )
-                else:
-                    socketio.emit(
-                        'server',
-                        {'msg': "No stream password"},
-                        room=request.sid,
-                    )
-        elif command in ["/mute", "/quiet"]:
-            if not (socket_to_info[request.sid].admin or socket_to_info[request.sid].moderator):
-                socketio.emit(
-                    'server',
-                    {'msg': f"Unrecognized command '{command}', use '/help' for info."},
-                    room=request.sid,
-                )
-                return
-
-            message = message.strip().lower()
-            for sinfo in socket_to_info.values():
-                if sinfo.username.lower() == message and sinfo.streamer == socket_to_info[request.sid].streamer:
-                    changed = (sinfo.muted is False)
-                    sinfo.muted = True
-
-                    if changed:
-                        socketio.emit(
-                            'server',
-                            {'msg': f"User '{message}' has been muted."},
-                            room=request.sid,
-                        )
-                        socketio.emit(
-                            'server',
-                            {'msg': "You have been muted."},
-                            room=sinfo.sid,
-                        )
-                    else:
-                        socketio.emit(
-                            'server',
-                            {'msg': f"User '{message}' is already muted."},
-                            room=request.sid,
-                        )
-                    break
-            else:
-                socketio.emit(
-                    'server',
-                    {'msg': f"Unrecognized user '{message}'"},
-                    room=request.sid,
-                )
-        elif command in ["/unmute", "/unquiet"]:
-            if not (socket_to_info[request.sid].admin or socket_to_info[request.sid].moderator):
-                socketio.emit(
-                    'server',
-                    {'msg': f"Unrecognized command '{command}', use '/help' for info."},
-                    room=request.sid,
-                )
-                return
-
-            message = message.strip().lower()
-            for sinfo in socket_to_info.values():
-                if sinfo.username.lower() == message and sinfo.streamer == socket_to_info[request.sid].streamer:
-                    changed = (sinfo.muted is True)
-                    sinfo.muted = False
-
-                    if changed:
-                        socketio.emit(
-                            'server',
-                            {'msg': f"User '{message}' has been unmuted."},
-                            room=request.sid,
-                        )
-                        socketio.emit(
-                            'server',
-                            {'msg': "You have been unmuted."},
-                            room=sinfo.sid,
-                        )
-                    else:
-                        socketio.emit(
-                            'server',
-                            {'msg': f"User '{message}' is not muted."},
-                            room=request.sid,
-                        )
-                    break
-            else:
-                socketio.emit(
-                    'server',
-                    {'msg': f"Unrecognized user '{message}'"},
-                    room=request.sid,
-                )
-        elif command in ["/mod"]:
-            if not socket_to_info[request.sid].admin:
-                socketio.emit(
-                    'server',
-                    {'msg': f"Unrecognized command '{command}', use '/help' for info."},
-                    room=request.sid,
-                )
-                return
-
-            message = message.strip().lower()
-            for sinfo in socket_to_info.values():
-                if sinfo.username.lower() == message and sinfo.streamer == socket_to_info[request.sid].streamer:
-                    changed = (sinfo.moderator is False)
-                    sinfo.moderator = True
-
-                    if changed:
-                        socketio.emit(
-                            'server',
-                            {'msg': f"User '{message}' has been promoted to moderator."},
-                            room=request.sid,
-                        )
-                        socketio.emit(
-                            'server',
-                            {'msg': "You have been promoted to moderator."},
-                            room=sinfo.sid,
-                        )
-                    else:
-                        socketio.emit(
-                            'server',
-                            {'msg': f"User '{message}' is already a moderator."},
-                            room=request.sid,
-                        )
-                    break
-            else:
-                socketio.emit(
-                    'server',
-                    {'msg': f"Unrecognized user '{message}'"},
-                    room=request.sid,
-                )
-        elif command in ["/demod", "/unmod"]:
-            if not socket_to_info[request.sid].admin:
-                socketio.emit(
-                    'server',
-                    {'msg': f"Unrecognized command '{command}', use '/help' for info."},
-                    room=request.sid,
-                )
-                return
-
-            message = message.strip().lower()
-            for sinfo in socket_to_info.values():
-                if sinfo.username.lower() == message and sinfo.streamer == socket_to_info[request.sid].streamer:
-                    changed = (sinfo.moderator is True)
-                    sinfo.moderator = False
-
-                    if changed:
-                        socketio.emit(
-                            'server',
-                            {'msg': f"User '{message}' has been demoted from moderator."},
-                            room=request.sid,
-                        )
-                        socketio.emit(
-                            'server',
-                            {'msg': "You have been demoted from moderator."},
-                            room=sinfo.sid,
-                        )
-                    else:
-                        socketio.emit(
-                            'server',
-                            {'msg': f"User '{message}' is not a moderator."},
-                            room=request.sid,
-                        )
-                    break
-            else:
-                socketio.emit(
-                    'server',
-                    {'msg': f"Unrecognized user '{message}'"},
-                    room=request.sid,
-                )
-        elif command in ["/desc", "/description"]:
-            if not socket_to_info[request.sid].admin:
-                socketio.emit(
-                    'server',
-                    {'msg': f"Unrecognized command '{command}', use '/help' for info."},
-                    room=request.sid,
-                )
-                return
-
-            streamer = socket_to_info[request.sid].streamer
-            description = emotes(message.strip())
-            mysql().execute(
-                "UPDATE streamersettings SET `description` = :description WHERE `username` = :streamer",
-                {"streamer": streamer, "description": description}
+
+
+_UNKNOWN_COMMAND = "Unrecognized command '%s', use '/help' for info."
+_UNKNOWN_USER = "Unrecognized user '%s'"
+
+
+def _emit_unknown_command(sid: Any, command: str) -> None:
+    socketio.emit('server', {'msg': _UNKNOWN_COMMAND % command}, to=sid)
+
+
+def _emit_unknown_user(sid: Any, username: str) -> None:
+    socketio.emit('server', {'msg': _UNKNOWN_USER % username}, to=sid)
+
+
+def _emit_pair(info: SocketInfo, msg: str, sinfo: SocketInfo, smsg: str) -> None:
+    """
+    Acknowledges a moderation command to the user who ran it and tells the user
+    it was run on.
+    """
+    socketio.emit('server', {'msg': msg}, to=info.sid)
+    socketio.emit('server', {'msg': smsg}, to=sinfo.sid)
+
+
+def _cmd_mute(info: SocketInfo, message: str) -> None:
+    message = message.strip().lower()
+    sinfo = find_user(info.streamer, message)
+    if sinfo is None:
+        _emit_unknown_user(info.sid, message)
+        return
+
+    with _streamer_locks[info.streamer]:
+        changed = not sinfo.muted
+        sinfo.muted = True
+
+        if changed:
+            _emit_pair(info, f"User '{message}' has been muted.", sinfo, "You have been muted.")
+        else:
+            socketio.emit(
+                'server',
+                {'msg': f"User '{message}' is already muted."},
+                to=info.sid,
             )
 
+
+def _cmd_unmute(info: SocketInfo, message: str) -> None:
+    message = message.strip().lower()
+    sinfo = find_user(info.streamer, message)
+    if sinfo is None:
+        _emit_unknown_user(info.sid, message)
+        return
+
+    with _streamer_locks[info.streamer]:
+        changed = sinfo.muted
+        sinfo.muted = False
+
+        if changed:
+            _emit_pair(info, f"User '{message}' has been unmuted.", sinfo, "You have been unmuted.")
+        else:
             socketio.emit(
                 'server',
-                {'msg': "Stream description updated!"},
-                room=request.sid,
+                {'msg': f"User '{message}' is not muted."},
+                to=info.sid,
             )
-        elif command in ["/password"]:
-            if not socket_to_info[request.sid].admin:
-                socketio.emit(
-                    'server',
-                    {'msg': f"Unrecognized command '{command}', use '/help' for info."},
-                    room=request.sid,
-                )
-                return
-
-            streamer = socket_to_info[request.sid].streamer
-            if message:
-                mysql().execute(
-                    "UPDATE streamersettings SET `streampass` = :password WHERE `username` = :streamer",
-                    {"streamer": streamer, "password": message}
-                )
-                socketio.emit(
-                    'server',
-                    {'msg': f"Stream password set to \"{message}\"!"},
-                    room=request.sid,
-                )
-                socketio.emit(
-                    'password set',
-                    {
-                        "password": message,
-                    },
-                    room=request.sid,
-                )
-                socketio.emit(
-                    'password activated',
-                    {
-                        "username": streamer,
-                    },
-                    room=socket_to_info[request.sid].streamer,
-                )
-            else:
-                mysql().execute(
-                    "UPDATE streamersettings SET `streampass` = :password WHERE `username` = :streamer",
-                    {"streamer": streamer, "password": None}
-                )
-                socketio.emit(
-                    'server',
-                    {'msg': "Stream password removed!"},
-                    room=request.sid,
-                )
-                socketio.emit(
-                    'password deactivated',
-                    {
-                        "username": streamer,
-                        "msg": "Stream password has been removed.",
-                    },
-                    room=socket_to_info[request.sid].streamer,
-                )
+
+
+def _cmd_mod(info: SocketInfo, message: str) -> None:
+    message = message.strip().lower()
+    sinfo = find_user(info.streamer, message)
+    if sinfo is None:
+        _emit_unknown_user(info.sid, message)
+        return
+
+    with _streamer_locks[info.streamer]:
+        changed = not sinfo.moderator
+        sinfo.moderator = True
+
+        if changed:
+            _emit_pair(info, f"User '{message}' has been promoted to moderator.", sinfo, "You have been promoted to moderator.")
         else:
             socketio.emit(
                 'server',
-                {'msg': f"Unrecognized command '{command}', use '/help' for info."},
-                room=request.sid,
+                {'msg': f"User '{message}' is already a moderator."},
+                to=info.sid,
             )
-            return
-    else:
-        if socket_to_info[request.sid].muted:
+
+
+def _cmd_demod(info: SocketInfo, message: str) -> None:
+    message = message.strip().lower()
+    sinfo = find_user(info.streamer, message)
+    if sinfo is None:
+        _emit_unknown_user(info.sid, message)
+        return
+
+    with _streamer_locks[info.streamer]:
+        changed = sinfo.moderator
+        sinfo.moderator = False
+
+        if changed:
+            _emit_pair(info, f"User '{message}' has been demoted from moderator.", sinfo, "You have been demoted from moderator.")
+        else:
             socketio.emit(
                 'server',
-                {'msg': "You are muted!"},
-                room=request.sid,
+                {'msg': f"User '{message}' is not a moderator."},
+                to=info.sid,
+            )
+
+
+def _cmd_description(info: SocketInfo, message: str) -> None:
+    streamer = info.streamer
+    description = emotes(message.strip())
+    with _streamer_locks[streamer]:
+        mysql().execute_stmt(
+            _UPDATE_DESCRIPTION,
+            {"streamer": streamer, "description": description},
+            write=True,
+        )
+        invalidate_streamer(streamer)
+
+        socketio.emit(
+            'server',
+            {'msg': "Stream description updated!"},
+            to=info.sid,
+        )
+
+
+def _cmd_password(info: SocketInfo, message: str) -> None:
+    streamer = info.streamer
+    with _streamer_locks[streamer]:
+        if message:
+            mysql().execute_stmt(
+                _UPDATE_STREAMPASS,
+                {"streamer": streamer, "password": message},
+                write=True,
+            )
+            invalidate_streamer(streamer)
+            # The admin's client shows the acknowledgement itself, so it rides along with
+            # the password instead of going out as a separate server message.
+            socketio.emit(
+                'password set',
+                {
+                    "password": message,
+                    "msg": f"Stream password set to \"{message}\"!",
+                },
+                to=info.sid,
+            )
+            socketio.emit(
+                'password activated',
+                {
+                    "username": streamer,
+                },
+                to=streamer,
             )
         else:
+            mysql().execute_stmt(
+                _UPDATE_STREAMPASS,
+                {"streamer": streamer, "password": None},
+                write=True,
+            )
+            invalidate_streamer(streamer)
+            socketio.emit(
+                'server',
+                {'msg': "Stream password removed!"},
+                to=info.sid,
+            )
             socketio.emit(
-                'message received',
+                'password deactivated',
                 {
-                    'username': socket_to_info[request.sid].username,
-                    'type': get_type(socket_to_info[request.sid]),
-                    'color': socket_to_info[request.sid].htmlcolor,
-                    'message': emotes(message),
+                    "username": streamer,
+                    "msg": "Stream password has been removed.",
                 },
-                room=socket_to_info[request.sid].streamer,
+                to=streamer,
             )
 
+
+# Every chat command, along with its aliases, mapped to the function that handles it and
+# who is allowed to run it.
+_CMD_TABLE: Dict[str, Tuple[CommandHandler, CommandPermission]] = {
+    "/say": (_cmd_say, _anyone),
+    "/me": (_cmd_action, _anyone),
+    "/action": (_cmd_action, _anyone),
+    "/describe": (_cmd_action, _anyone),
+    "/color": (_cmd_color, _anyone),
+    "/setcolor": (_cmd_color, _anyone),
+    "/name": (_cmd_name, _anyone),
+    "/nick": (_cmd_name, _anyone),
+    "/help": (_cmd_help, _anyone),
+    "/users": (_cmd_users, _anyone),
+    "/settings": (_cmd_settings, _admins),
+    "/mute": (_cmd_mute, _moderators),
+    "/quiet": (_cmd_mute, _moderators),
+    "/unmute": (_cmd_unmute, _moderators),
+    "/unquiet": (_cmd_unmute, _moderators),
+    "/mod": (_cmd_mod, _admins),
+    "/demod": (_cmd_demod, _admins),
+    "/unmod": (_cmd_demod, _admins),
+    "/desc": (_cmd_description, _admins),
+    "/description": (_cmd_description, _admins),
+    "/password": (_cmd_password, _admins),
+}
+
+
+@socketio.on('message')  # type: ignore
+def handle_message(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -> None:
+    sid = request.sid
+    if 'message' not in json:
+        socketio.emit('error', {'msg': 'Message mssing from JSON?'}, to=sid)
+        return
+
+    message = json['message'].strip()
+    if len(message) == 0:
+        socketio.emit('warning', {'msg': 'Message cannot be blank'}, to=sid)
+        return
+
+    info = socket_to_info.get(sid)
+    if info is None:
+        socketio.emit('error', {'msg': 'User is not authenticated?'}, to=sid)
+        return
+
+    # Update user presence information
+    update_presence(sid, info.streamer)
+
+    if message.startswith('/'):
+        # Command of some sort
+        if ' ' in message:
+            command, message = message.split(' ', 1)
+        else:
+            command = message
+            message = ""
+
+        entry = _CMD_TABLE.get(command)
+        if entry is None or not entry[1](info):
+            # Commands that somebody isn't allowed to run look the same as ones that
+            # don't exist, so regular users can't discover the admin commands.
+            _emit_unknown_command(info.sid, command)
+            return
+
+        entry[0](info, message)
+    else:
+        _cmd_say(info, message)
+
+
 @socketio.on('get color')
 def return_color(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -> None:
-    if request.sid not in socket_to_info:
-        socketio.emit('error', {'msg': 'User is not authenticated?'}, room=request.sid)
+    sid = request.sid
+    info = socket_to_info.get(sid)
+    if info is None:
+        socketio.emit('error', {'msg': 'User is not authenticated?'}, to=sid)
         return
 
     socketio.emit(
             'return color',
             {
-                'color': socket_to_info[request.sid].htmlcolor,
+                'color': info.htmlcolor,
             },
-            room=request.sid,
+            to=sid,
         )
 
 @socketio.on('drawing')  # type: ignore
 def handle_drawing(json: Dict[str, Any], methods: List[str] = ['GET', 'POST']) -> None:
+    sid = request.sid
     if 'src' not in json:
-        socketio.emit('error', {'msg': 'Image mssing from JSON?'}, room=request.sid)
+        socketio.emit('error', {'msg': 'Image mssing from JSON?'}, to=sid)
         return
 
-    if request.sid not in socket_to_info:
-        socketio.emit('error', {'msg': 'User is not authenticated?'}, room=request.sid)
+    info = socket_to_info.get(sid)
+    if info is None:
+        socketio.emit('error', {'msg': 'User is not authenticated?'}, to=sid)
         return
 
     # Update user presence information
-    socket_to_presence[request.sid] = PresenceInfo(request.sid, socket_to_info[request.sid].streamer)
+    streamer = info.streamer
+    update_presence(sid, streamer)
 
     src = json['src'].strip()
 
-    if socket_to_info[request.sid].muted:
+    if info.muted:
             socketio.emit(
                 'server',
                 {'msg': "You are muted!"},
-                room=request.sid,
+                to=sid,
             )
     else:
         socketio.emit(
             'drawing received',
             {
-                'username': socket_to_info[request.sid].username,
-                'type': get_type(socket_to_info[request.sid]),
-                'color': socket_to_info[request.sid].htmlcolor,
+                'username': info.username,
+                'type': get_type(info),
+                'color': info.htmlcolor,
                 'src': src,
             },
-            room=socket_to_info[request.sid].streamer,
+            to=streamer,
         )
 
 def load_config(filename: str) -> None:
     global config
+    global HLS_DIR
+    global HLS_TTL
 
-    config.update(yaml.safe_load(open(filename)))
+    with open(filename) as fp:
+        config.update(yaml.load(fp, Loader=SafeLoader))
+    HLS_DIR = config['hls_dir']
+    HLS_TTL = int(config['hls_playlist_length'])
     config['database']['engine'] = Data.create_engine(config)
+    config['database']['data'] = Data(config)
     app.secret_key = config['secret_key']
+    socketio.init_app(app, message_queue=config.get('message_queue'))
 
 
 if __name__ == '__main__':
@@ -1132,4 +1304,13 @@ if __name__ == '__main__':
 
     if args.nginx_proxy > 0:
         app.wsgi_app = ProxyFix(app.wsgi_app, x_host=args.nginx_proxy, x_proto=args.nginx_proxy, x_for=args.nginx_proxy)  # type: ignore
-    socketio.run(app, host='0.0.0.0', port=args.port, debug=args.debug)
+    if args.debug:
+        # Keep the reloader and request logging that Flask-SocketIO sets up in debug mode.
+        socketio.run(app, host='0.0.0.0', port=args.port, debug=True)
+    else:
+        # Chat acks and drawings are small packets that shouldn't sit around waiting on
+        # Nagle's algorithm. Linux copies the option from the listening socket onto every
+        # connection it accepts, websocket upgrades included.
+        listener = socket.create_server(('0.0.0.0', args.port))
+        listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        WSGIServer(listener, app, handler_class=WebSocketHandler, log=None).serve_forever()
@@ -1,4 +1,5 @@
 import os
+import re
 from typing import Any, Dict, Optional
 
 import alembic.config
@@ -8,6 +9,7 @@ from sqlalchemy import Table, Column, MetaData, create_engine
 from sqlalchemy.orm import scoped_session, sessionmaker
 from sqlalchemy.engine import Engine, Result  # type: ignore
 from sqlalchemy.sql import text
+from sqlalchemy.sql.elements import TextClause
 from sqlalchemy.exc import ProgrammingError
 from sqlalchemy.types import String
 
@@ -15,6 +17,15 @@ from sqlalchemy.types import String
 metadata = MetaData()
 
 
+# Where alembic's config, environment and migration scripts live.
+_BASE_DIR = os.path.abspath(os.path.dirname(__file__))
+_ALEMBIC_INI = os.path.join(_BASE_DIR, 'alembic.ini')
+
+
+# Statements that read-only mode refuses to run.
+_WRITE_RE = re.compile(r'^\s*(insert\s+into|update|delete\s+from)\b', re.IGNORECASE)
+
+
 """
 Table for storing streamer settings.
 """
@@ -60,8 +71,8 @@ class Data:
         """
         session_factory = sessionmaker(
             bind=config['database']['engine'],
-            autoflush=True,
-            autocommit=True,
+            autoflush=False,
+            autocommit=False,
         )
         self.__config = config
         self.__session: Optional[scoped_session] = scoped_session(session_factory)
@@ -75,6 +86,9 @@ class Data:
     def create_engine(cls, config: Dict[str, Any]) -> Engine:
         return create_engine(
             Data.sqlalchemy_url(config),
+            pool_size=20,
+            max_overflow=10,
+            pool_pre_ping=True,
             pool_recycle=3600,
         )
 
@@ -85,23 +99,23 @@ class Data:
                 cursor = self.__session.execute(text('SELECT COUNT(version_num) AS count FROM alembic_version'))
                 return bool(cursor.fetchone()['count'] == 1)
             except ProgrammingError:
+                # Don't leave the failed statement's transaction hanging around.
+                self.__session.rollback()
                 return False
         else:
             raise Exception("Our connection to the DB was closed!")
 
     def __alembic_cmd(self, command: str, *args: str) -> None:
-        base_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), './')
         alembicArgs = [
             '-c',
-            os.path.join(base_dir, 'alembic.ini'),
+            _ALEMBIC_INI,
             '-x',
-            f'script_location={base_dir}',
+            f'script_location={_BASE_DIR}',
             '-x',
             f'sqlalchemy.url={self.__url}',
             command,
+            *args,
         ]
-        alembicArgs.extend(args)
-        os.chdir(base_dir)
         alembic.config.main(argv=alembicArgs)  # type: ignore
 
     def create(self) -> None:
@@ -164,6 +178,14 @@ class Data:
             self.__session.close()
             self.__session = None
 
+    def release(self) -> None:
+        """
+        Release the current session's connection back to the engine's pool, leaving
+        this object usable for the next web request or chat event.
+        """
+        if self.__session is not None:
+            self.__session.remove()  # type: ignore[no-untyped-call]
+
     def execute(self, sql: str, params: Optional[Dict[str, Any]] = None, safe_write_operation: bool = False) -> Result:
         """
         Given a SQL string and some parameters, execute the query and return the result.
@@ -175,19 +197,38 @@ class Data:
         Returns:
             A SQLAlchemy Result object.
         """
-        if self.__config['database'].get('read_only', False):
-            # See if this is an insert/update/delete
-            for write_statement in [
-                "insert into ",
-                "update ",
-                "delete from ",
-            ]:
-                if write_statement in sql.lower() and not safe_write_operation:
-                    raise Exception('Read-only mode is active!')
+        # See if this is an insert/update/delete
+        if not safe_write_operation and self.__config['database'].get('read_only', False) and _WRITE_RE.match(sql):
+            raise Exception('Read-only mode is active!')
+        return self.execute_stmt(text(sql), params)
+
+    def execute_stmt(self, stmt: TextClause, params: Optional[Dict[str, Any]] = None, write: bool = False, safe_write_operation: bool = False) -> Result:
+        """
+        Given an already compiled SQL statement and some parameters, execute the query and
+        return the result. Use this for fixed statements that run often, so that they are
+        built once instead of on every call.
+
+        Parameters:
+            stmt - The SQL statement to execute, as returned by text().
+            params - Dictionary of parameters which will be substituted into the statement.
+            write - Whether the statement is an insert/update/delete, for the read-only check.
+
+        Returns:
+            A SQLAlchemy Result object.
+        """
+        if write and not safe_write_operation and self.__config['database'].get('read_only', False):
+            raise Exception('Read-only mode is active!')
         if self.__session is not None:
-            return self.__session.execute(
-                text(sql),
+            result = self.__session.execute(
+                stmt,
                 params if params is not None else {},
             )
+            if not result.returns_rows:
+                # Anything that doesn't hand back rows changed something, so commit it right
+                # away instead of trusting write detection to catch every kind of statement.
+                # Reads ride along in whatever transaction is open until the session is
+                # released.
+                self.__session.commit()
+            return result
         else:
             raise Exception("Our connection to the DB was closed!")
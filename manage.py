@@ -3,6 +3,11 @@ import sys
 import yaml
 from typing import Any, Dict, Optional
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader  # type: ignore
+
 from data import Data, DBCreateException
 
 
@@ -181,7 +186,8 @@ def main() -> None:
     parser.add_argument("-c", "--config", help="Core configuration. Defaults to config.yaml", type=str, default="config.yaml")
     args = parser.parse_args()
 
-    config = yaml.safe_load(open(args.config))
+    with open(args.config) as fp:
+        config = yaml.load(fp, Loader=SafeLoader)
     config['database']['engine'] = Data.create_engine(config)
     try:
         if args.operation == "create":